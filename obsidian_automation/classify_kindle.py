@@ -1,9 +1,19 @@
 import os
 import json
+import asyncio
+import functools
 import shutil
 import glob
 from pathlib import Path
 from dotenv import load_dotenv
+from llm_retry import MAX_ATTEMPTS, backoff_delay, is_retryable_genai_error
+from llm_text import strip_code_fence
+
+# orjson is faster; fall back to the standard library if it is not installed
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
 
 # Load .env from script directory
 script_dir = Path(__file__).parent
@@ -40,12 +50,16 @@ if USE_MOCK:
             return None
     types = MockTypes()
 
-client = genai.Client(api_key=API_KEY)
+@functools.lru_cache(maxsize=1)
+def _client():
+    # Created on first use and shared by every request in the process
+    return genai.Client(api_key=API_KEY, http_options={"timeout": 60_000})
 
 KINDLE_PROMPT_TEMPLATE = """
 あなたは読書メモ整理アシスタントです。
-以下は、あるKindle本のハイライトノートの一部です（タイトルといくつかの抜粋を含みます）。
-この本が主に扱っているテーマを、次の候補から最も近いものを1つだけ選んでください。
+以下は、いくつかのKindle本のハイライトノートの一部です（それぞれタイトルといくつかの抜粋を含みます）。
+各ノートは [[番号]] で始まります。
+それぞれの本が主に扱っているテーマを、次の候補から最も近いものを1つだけ選んでください。
 
 - 健康
 - 家づくり
@@ -57,29 +71,131 @@ KINDLE_PROMPT_TEMPLATE = """
 出力は次のJSON形式のみとし、余計な説明は一切書かないでください。
 
 ```json
-{{"theme": "健康"}}
+[{{"id": 1, "theme": "健康"}}, {{"id": 2, "theme": "仕事"}}]
 ```
-のように、"theme" に上記の候補のいずれか1つを入れてください。
+のように、すべてのノートについて "id" に番号、"theme" に上記の候補のいずれか1つを入れてください。
 
 以下がハイライトノートです：
-{highlight_extract}
+{highlight_extracts}
 """
 
-def classify_kindle_notes():
-    if not VAULT_DIR:
-        print("Error: VAULT_DIR is not set in .env")
-        return
+NOTE_EXTRACT_TEMPLATE = """
+[[{id}]]
+{extract}
+"""
 
-    inbox_path = Path(VAULT_DIR) / "20_inputs/Resource_Kindle読書/_inbox"
-    if not inbox_path.exists():
-        print(f"Directory not found: {inbox_path}")
-        return
+MODEL = "gemini-2.0-flash"
+MAX_CONCURRENT_REQUESTS = 8
+BATCH_SIZE = 20
+
+# Clear-cut notes are classified by keyword counts without calling the API
+KEYWORDS = {
+    "健康": ["健康", "運動", "睡眠", "食事", "筋トレ"],
+    "家づくり": ["家づくり", "間取り", "住宅", "工務店", "新築"],
+    "子育て": ["子育て", "育児", "子ども", "子供"],
+    "仕事": ["仕事", "キャリア", "マネジメント", "ビジネス"],
+    "お金": ["お金", "投資", "資産", "節約", "家計"]
+}
+KEYWORD_THRESHOLD = 3
+
+def generate_classification(prompt):
+    if USE_MOCK:
+        return _client().generate_content(
+            model=MODEL,
+            contents=prompt
+        )
+    return _client().models.generate_content(
+        model=MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            response_mime_type="application/json"
+        )
+    )
+
+async def generate_with_retry(prompt):
+    # Jittered backoff, so batches that hit a 429 together don't retry in lockstep
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return await asyncio.to_thread(generate_classification, prompt)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable_genai_error(e):
+                raise
+            wait = backoff_delay(attempt)
+            print(f"API busy ({e}), retrying in {wait:.1f}s...")
+            await asyncio.sleep(wait)
+
+def keyword_theme(extract):
+    """
+    キーワードの出現回数でテーマを判定する
+    最多のテーマが閾値以上かつ2位の2倍以上のときだけ返し、曖昧なら None
+    """
+    scores = sorted(
+        ((sum(extract.count(k) for k in kws), theme) for theme, kws in KEYWORDS.items()),
+        reverse=True
+    )
+    (best, theme), (second, _) = scores[0], scores[1]
+    if best >= KEYWORD_THRESHOLD and best >= 2 * second:
+        return theme
+    return None
+
+def move_to_theme(file_path, theme):
+    target_dir = Path(VAULT_DIR) / f"20_inputs/Resource_Kindle読書/Kindle_{theme}"
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target_path = target_dir / file_path.name
+
+    shutil.move(str(file_path), str(target_path))
+    print(f"Moved to: {target_path}")
+
+async def classify_batch(batch, sem):
+    try:
+        extracts = [
+            NOTE_EXTRACT_TEMPLATE.format(id=i, extract=extract)
+            for i, (_, extract) in enumerate(batch, start=1)
+        ]
 
-    files = list(inbox_path.glob("*.md"))
-    if not files:
-        print("No files found in inbox.")
-        return
+        prompt = KINDLE_PROMPT_TEMPLATE.format(highlight_extracts="".join(extracts))
+
+        # Call API (one request for the whole batch)
+        async with sem:
+            response = await generate_with_retry(prompt)
 
+        # Parse JSON
+        try:
+            # Handle code block wrapping if present (though prompt asks for JSON)
+            text = strip_code_fence(response.text)
+            data = _json_loads(text)
+        except json.JSONDecodeError:
+            data = None
+
+        if not isinstance(data, list):
+            names = ", ".join(file_path.name for file_path, _ in batch)
+            print(f"Failed to parse JSON for {names}. Response: {response.text}")
+            return
+
+        themes = {}
+        for item in data:
+            if isinstance(item, dict) and "id" in item:
+                themes[str(item["id"])] = item.get("theme", "その他")
+
+        # Move files
+        for i, (file_path, _) in enumerate(batch, start=1):
+            theme = themes.get(str(i))
+            if theme is None:
+                print(f"No theme returned for {file_path.name}")
+                continue
+            try:
+                move_to_theme(file_path, theme)
+            except Exception as e:
+                print(f"Error moving {file_path.name}: {e}")
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        names = ", ".join(file_path.name for file_path, _ in batch)
+        print(f"Error processing {names}: {e}")
+
+async def classify_files(files):
+    pending = []
     for file_path in files:
         try:
             print(f"Processing: {file_path.name}")
@@ -89,52 +205,42 @@ def classify_kindle_notes():
             # Extract title and first few lines (e.g., first 2000 chars)
             extract = content[:2000]
 
-            prompt = KINDLE_PROMPT_TEMPLATE.format(highlight_extract=extract)
-
-            # Call API
-            if USE_MOCK:
-                 response = client.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=prompt
-                )
+            theme = keyword_theme(extract)
+            if theme:
+                print(f"Keyword match: {theme}")
+                move_to_theme(file_path, theme)
             else:
-                response = client.models.generate_content(
-                    model="gemini-2.0-flash",
-                    contents=prompt,
-                    config=types.GenerateContentConfig(
-                        response_mime_type="application/json"
-                    )
-                )
-
-            # Parse JSON
-            try:
-                # Handle code block wrapping if present (though prompt asks for JSON)
-                text = response.text.strip()
-                if text.startswith("```json"):
-                    text = text.split("```json")[1].split("```")[0].strip()
-                elif text.startswith("```"):
-                    text = text.split("```")[1].split("```")[0].strip()
-
-                print(f"DEBUG: Response text: {text}")
-                data = json.loads(text)
-                print(f"DEBUG: Parsed data: {data}, type: {type(data)}")
-                theme = data.get("theme", "その他")
-            except json.JSONDecodeError:
-                print(f"Failed to parse JSON for {file_path.name}. Response: {response.text}")
-                continue
+                pending.append((file_path, extract))
+        except Exception as e:
+            print(f"Error processing {file_path.name}: {e}")
 
-            # Move file
-            target_dir = Path(VAULT_DIR) / f"20_inputs/Resource_Kindle読書/Kindle_{theme}"
-            target_dir.mkdir(parents=True, exist_ok=True)
-            target_path = target_dir / file_path.name
+    if not pending:
+        return
 
-            shutil.move(str(file_path), str(target_path))
-            print(f"Moved to: {target_path}")
+    # Build the client here, before the worker threads race to create their own
+    _client()
 
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f"Error processing {file_path.name}: {e}")
+    # Several extracts share one request; keep a bounded number of requests in flight
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    batches = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+    await asyncio.gather(*(classify_batch(batch, sem) for batch in batches))
+
+def classify_kindle_notes():
+    if not VAULT_DIR:
+        print("Error: VAULT_DIR is not set in .env")
+        return
+
+    inbox_path = Path(VAULT_DIR) / "20_inputs/Resource_Kindle読書/_inbox"
+    if not inbox_path.exists():
+        print(f"Directory not found: {inbox_path}")
+        return
+
+    files = list(inbox_path.glob("*.md"))
+    if not files:
+        print("No files found in inbox.")
+        return
+
+    asyncio.run(classify_files(files))
 
 if __name__ == "__main__":
     classify_kindle_notes()
@@ -2,8 +2,13 @@ import os
 import argparse
 import sys
 import re
+import queue
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
+from llm_text import strip_code_fence
 
 # Load .env from script directory
 script_dir = Path(__file__).parent
@@ -14,32 +19,89 @@ VAULT_DIR = os.getenv("VAULT_DIR")
 API_KEY = os.getenv("GEMINI_API_KEY")
 USE_MOCK = os.getenv("USE_MOCK", "false").lower() == "true"
 
+# Pages are OCR'd in parallel, so keep each Tesseract instance single-threaded
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+class PytesseractBaseAPI:
+    """
+    tesserocr.PyTessBaseAPI と同じ呼び出し方で pytesseract を使うラッパー
+    """
+    def __init__(self, lang='jpn', psm=None, variables=None):
+        self.lang = lang
+        options = [f"--psm {psm}"] if psm is not None else []
+        # Tesseract variables are passed on the command line as -c name=value
+        options.extend(f"-c {k}={v}" for k, v in (variables or {}).items())
+        self.config = " ".join(options)
+        self.image = None
+
+    def SetImage(self, image):
+        self.image = image
+
+    def GetUTF8Text(self):
+        return pytesseract.image_to_string(self.image, lang=self.lang, config=self.config)
+
+    def End(self):
+        pass
+
+class PytesseractPSM:
+    AUTO = 3
+
 # Imports
 if not USE_MOCK:
     try:
         from google import genai
         from google.genai import types
-        import pytesseract
-        from pdf2image import convert_from_path
+        from pdf2image import convert_from_path, pdfinfo_from_path
+        from PIL import Image
     except ImportError:
         USE_MOCK = True
 
+# OpenCV is only used for binarization; without it pages are OCR'd unbinarized
+try:
+    import cv2
+    import numpy as np
+    HAS_CV2 = True
+except ImportError:
+    print("opencv-python-headless not found, skipping binarization")
+    HAS_CV2 = False
+
+if not USE_MOCK:
+    # OCR is never swapped for the mock here: mock text would end up in the real daily note
+    try:
+        from tesserocr import PyTessBaseAPI, PSM
+    except ImportError:
+        # tesserocr has to be built against libtesseract; fall back to the pytesseract CLI wrapper
+        try:
+            import pytesseract
+        except ImportError:
+            sys.exit("Error: OCR needs tesserocr or pytesseract. Run: pip install -r requirements.txt")
+        print("tesserocr not found, using pytesseract")
+        PyTessBaseAPI = PytesseractBaseAPI
+        PSM = PytesseractPSM()
+
 if USE_MOCK:
     print("Using Mocks")
-    from mocks import MockGenAIClient, mock_convert_from_path, mock_image_to_string
+    from mocks import MockGenAIClient, mock_convert_from_path, mock_pdfinfo_from_path, mock_image_to_string
     convert_from_path = mock_convert_from_path
+    pdfinfo_from_path = mock_pdfinfo_from_path
 
     # Mock pytesseract module
     class MockPyTesseract:
-        def image_to_string(self, image, lang='jpn'):
+        def image_to_string(self, image, lang='jpn', config=''):
             return mock_image_to_string(image, lang)
     pytesseract = MockPyTesseract()
 
+    PyTessBaseAPI = PytesseractBaseAPI
+    PSM = PytesseractPSM()
+
     class MockGenAIModule:
         Client = MockGenAIClient
     genai = MockGenAIModule()
 
-client = genai.Client(api_key=API_KEY)
+@functools.lru_cache(maxsize=1)
+def _client():
+    # Created on first use and shared by every request in the process
+    return genai.Client(api_key=API_KEY, http_options={"timeout": 60_000})
 
 COACHING_PROMPT_TEMPLATE = """
 あなたは行動レベルに落とし込むコーチです。
@@ -82,6 +144,22 @@ COACHING_PROMPT_TEMPLATE = """
 {gratitude}
 """
 
+# OCR section labels on the handwritten sheet
+_SECTION_PATTERNS = {
+    "scan": re.compile(r"#\s*1"),
+    "emotion": re.compile(r"#\s*2"),
+    "gratitude": re.compile(r"#\s*3"),
+    "step": re.compile(r"#\s*4")
+}
+
+# Headers in the AI coaching response
+AI_HEADERS = ("## 改善ポイント（AIコーチ）", "## 明日のアクション（AIコーチ）")
+
+
+# Splits a note into [preamble, header_line1, body1, header_line2, body2, ...];
+# header lines keep their newline so "".join(parts) gives back the note unchanged
+_SECTION_SPLIT = re.compile(r"^(## [^\n]*(?:\n|\Z))", re.MULTILINE)
+
 def extract_section(text, label):
     # Heuristic to find text between labels
     # Labels: #1, #2, #3, #4
@@ -94,17 +172,10 @@ def extract_section(text, label):
     # #3 -> 感謝と自己肯定
     # #4 -> 明日の一歩
 
-    pattern_map = {
-        "scan": r"#\s*1",
-        "emotion": r"#\s*2",
-        "gratitude": r"#\s*3",
-        "step": r"#\s*4"
-    }
-
     # Find start indices
     indices = {}
-    for key, pat in pattern_map.items():
-        match = re.search(pat, text)
+    for key, pattern in _SECTION_PATTERNS.items():
+        match = pattern.search(text)
         if match:
             indices[key] = match.start()
         else:
@@ -133,6 +204,123 @@ def clean_section_text(text):
         return '\n'.join(lines[1:]).strip()
     return text
 
+def downscale(img, max_side=2000):
+    # OCR cost scales with pixel count; cap the longest edge, keep aspect ratio
+    img = img.convert('L')
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    return img
+
+def preprocess(img):
+    # Grayscale + Otsu binarization, so Tesseract gets a clean 1-bit page
+    if not HAS_CV2:
+        return downscale(img)
+    arr = np.array(downscale(img))
+    _, bw = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return Image.fromarray(bw)
+
+def merge_sections(content, updates):
+    """
+    ノートを ## 見出しごとに一度だけ分割し、
+    updates の見出しは本文を置き換え、存在しなければ末尾に追加する
+    それ以外のセクションは分割したままの形で書き戻す
+    """
+    parts = _SECTION_SPLIT.split(content)
+    out = [parts[0]]
+    remaining = dict(updates)
+
+    sections = list(zip(parts[1::2], parts[2::2]))
+    for i, (header_line, body) in enumerate(sections):
+        header = header_line.rstrip()
+        if header not in remaining:
+            out.append(header_line)
+            out.append(body)
+            continue
+
+        # Only the first occurrence of a header is replaced
+        out.append(f"{header}\n{remaining.pop(header)}\n")
+        if i < len(sections) - 1:
+            out.append("\n")
+
+    if remaining:
+        text = "".join(out)
+        if text.endswith("\n\n") or not text:
+            sep = ""
+        elif text.endswith("\n"):
+            sep = "\n"
+        else:
+            sep = "\n\n"
+        out = [text, sep, "\n".join(f"{header}\n{body}\n" for header, body in remaining.items())]
+
+    return "".join(out)
+
+def ocr_pdf(pdf_path):
+    # Pipeline: one thread rasterizes pages one at a time while the OCR
+    # workers process the pages already produced.
+    page_count = pdfinfo_from_path(str(pdf_path))["Pages"]
+    workers = os.cpu_count() or 1
+
+    pages = queue.Queue(maxsize=2)
+    in_flight = threading.BoundedSemaphore(workers)
+
+    # Each worker thread reuses its own in-process Tesseract instance,
+    # so the jpn model is loaded once per thread instead of once per page.
+    apis = queue.SimpleQueue()
+
+    def rasterize():
+        try:
+            for page in range(1, page_count + 1):
+                for img in convert_from_path(
+                    str(pdf_path),
+                    first_page=page,
+                    last_page=page,
+                    dpi=150,
+                    use_pdftocairo=True,
+                    grayscale=True,
+                    fmt='jpeg'
+                ):
+                    pages.put(img)
+        finally:
+            pages.put(None)
+
+    def ocr_page(img):
+        # A failed page should not abort the whole batch
+        try:
+            try:
+                api = apis.get_nowait()
+            except queue.Empty:
+                api = PyTessBaseAPI(
+                    lang='jpn',
+                    psm=PSM.AUTO,
+                    variables={"tessedit_do_invert": "0"}
+                )
+            try:
+                api.SetImage(img if USE_MOCK else preprocess(img))
+                return api.GetUTF8Text()
+            finally:
+                apis.put(api)
+        except Exception as e:
+            print(f"OCR Failed for page: {e}")
+            return ""
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=1) as raster_ex, \
+                ThreadPoolExecutor(max_workers=workers) as ocr_ex:
+            producer = raster_ex.submit(rasterize)
+            futures = []
+            while (img := pages.get()) is not None:
+                # Don't pull pages faster than the workers can OCR them
+                in_flight.acquire()
+                futures.append(ocr_ex.submit(ocr_page, img))
+            producer.result()
+            texts = [future.result() for future in futures]
+    finally:
+        while not apis.empty():
+            apis.get().End()
+
+    return "\n".join(texts)
+
 def daily_pipeline(date_str):
     if not VAULT_DIR:
         print("Error: VAULT_DIR is not set in .env")
@@ -152,11 +340,7 @@ def daily_pipeline(date_str):
 
     # OCR
     try:
-        images = convert_from_path(str(pdf_path))
-        full_text = ""
-        for img in images:
-            text = pytesseract.image_to_string(img, lang='jpn')
-            full_text += text + "\n"
+        full_text = ocr_pdf(pdf_path)
     except Exception as e:
         print(f"OCR Failed: {e}")
         return
@@ -186,27 +370,19 @@ def daily_pipeline(date_str):
 
     try:
         if USE_MOCK:
-             response = client.generate_content(
+             response = _client().generate_content(
                 model="gemini-2.0-flash",
                 contents=prompt
             )
         else:
-            response = client.models.generate_content(
+            response = _client().models.generate_content(
                 model="gemini-2.0-flash",
                 contents=prompt
             )
         ai_response = response.text
 
         # Clean markdown fences
-        if ai_response.startswith("```markdown"):
-            ai_response = ai_response.replace("```markdown", "", 1)
-            if ai_response.endswith("```"):
-                ai_response = ai_response[:-3]
-        elif ai_response.startswith("```"):
-            ai_response = ai_response.replace("```", "", 1)
-            if ai_response.endswith("```"):
-                ai_response = ai_response[:-3]
-        ai_response = ai_response.strip()
+        ai_response = strip_code_fence(ai_response)
 
     except Exception as e:
         print(f"AI Failed: {e}")
@@ -236,15 +412,6 @@ def daily_pipeline(date_str):
     else:
         content = f"# {date_str} Daily Note\n"
 
-    # Helper to replace or append
-    for header, body in new_sections.items():
-        pattern = re.compile(f"({re.escape(header)}).*?(?=\n## |$)", re.DOTALL)
-        replacement = f"{header}\n{body}\n"
-        if pattern.search(content):
-            content = pattern.sub(replacement, content, count=1)
-        else:
-            content += f"\n\n{replacement}"
-
     # Handle AI response parts
     # The AI response comes as a block with headers.
     # We should replace/append them individually or as a block?
@@ -264,16 +431,13 @@ def daily_pipeline(date_str):
     # Extract from AI response
     ai_sections = {}
 
-    # Regex to find headers in AI response
-    ai_headers = ["## 改善ポイント（AIコーチ）", "## 明日のアクション（AIコーチ）"]
-
     current_header = None
     buffer = []
 
     for line in ai_response.split('\n'):
         line = line.strip()
         is_header = False
-        for h in ai_headers:
+        for h in AI_HEADERS:
             if line.startswith(h):
                 if current_header:
                     ai_sections[current_header] = '\n'.join(buffer).strip()
@@ -287,14 +451,8 @@ def daily_pipeline(date_str):
     if current_header:
         ai_sections[current_header] = '\n'.join(buffer).strip()
 
-    # Now merge AI sections into file content
-    for header, body in ai_sections.items():
-        pattern = re.compile(f"({re.escape(header)}).*?(?=\n## |$)", re.DOTALL)
-        replacement = f"{header}\n{body}\n"
-        if pattern.search(content):
-            content = pattern.sub(replacement, content, count=1)
-        else:
-            content += f"\n\n{replacement}"
+    # Merge OCR and AI sections into file content in a single pass
+    content = merge_sections(content, {**new_sections, **ai_sections})
 
     with open(daily_note_path, "w", encoding="utf-8") as f:
         f.write(content)
@@ -1,7 +1,10 @@
 import os
 import argparse
 import datetime
+import hashlib
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -22,64 +25,54 @@ if USE_MOCK:
     print("Using Mock Newspaper3k")
     from mocks import MockArticle as Article
 
-def fetch_raindrop_body():
-    parser = argparse.ArgumentParser(description="Fetch article body for Raindrop notes.")
-    parser.add_argument("start_date", nargs="?", help="Start date (YYYY-MM-DD) to filter files by created date.")
-    args = parser.parse_args()
-
-    if not VAULT_DIR:
-        print("Error: VAULT_DIR is not set in .env")
-        return
-
-    raindrop_dir = Path(VAULT_DIR) / "20_inputs/Resource_Raindrop"
-    if not raindrop_dir.exists():
-        print(f"Directory not found: {raindrop_dir}")
-        return
-
-    start_date = None
-    if args.start_date:
-        try:
-            start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d").date()
-        except ValueError:
-            print("Invalid date format. Use YYYY-MM-DD.")
-            return
-
-    files = list(raindrop_dir.glob("*.md"))
-    if not files:
-        print("No files found.")
-        return
-
-    for file_path in files:
-        try:
-            # Parse Frontmatter
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read()
+# libyaml's C loader is much faster than the pure-Python one
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+MAX_FETCH_WORKERS = 16
+HEAD_READ_SIZE = 4096
+BODY_HEADER = "## 本文（newspaper3k）"
+
+def parse_and_fetch(file_path, start_date=None):
+    """
+    Frontmatterを解析し、対象ファイルであれば記事本文を取得する
+    対象外のファイルや失敗時は None を返す
+    """
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            # Read only the head first; the rest is read once the file passes the filters
+            content = f.read(HEAD_READ_SIZE)
 
             if not content.startswith("---"):
-                continue
+                return None
 
             # Split frontmatter
-            parts = content.split("---", 2)
-            if len(parts) < 3:
-                continue
+            end = content.find("---", 3)
+            if end == -1:
+                # Frontmatter is longer than the head
+                content += f.read()
+                end = content.find("---", 3)
+                if end == -1:
+                    return None
 
-            frontmatter_str = parts[1]
-            body_text = parts[2]
+            frontmatter_str = content[3:end]
 
             try:
-                fm = yaml.safe_load(frontmatter_str)
+                fm = yaml.load(frontmatter_str, Loader=SafeLoader)
             except yaml.YAMLError:
                 print(f"Failed to parse YAML for {file_path.name}")
-                continue
+                return None
 
             if not fm:
-                continue
+                return None
 
             # Check date filter
             created_val = fm.get("created")
             if start_date:
                 if not created_val:
-                    continue
+                    return None
                 # Handle various date formats if necessary, assuming string or date obj
                 if isinstance(created_val, datetime.date):
                     file_date = created_val
@@ -93,45 +86,102 @@ def fetch_raindrop_body():
                     file_date = None
 
                 if not file_date or file_date < start_date:
-                    continue
+                    return None
 
             url = fm.get("link")
             if not url:
-                continue
+                return None
+
+            content += f.read()
+
+        body_text = content[end + 3:]
 
-            print(f"Processing: {file_path.name} ({url})")
+        print(f"Processing: {file_path.name} ({url})")
 
-            # Fetch body
-            article = Article(url)
-            article.download()
-            article.parse()
+        # Fetch body
+        article = Article(url)
+        article.download()
+        article.parse()
 
-            extracted_text = article.text.strip()
+        extracted_text = article.text.strip()
 
-            # Append section
-            header = "\n\n## 本文（newspaper3k）\n"
+        return file_path, frontmatter_str, body_text, extracted_text
 
-            # Check if header already exists
-            if "## 本文（newspaper3k）" in body_text:
-                # Replace existing section (regex or split)
-                # Simple approach: split by header and keep first part
-                pre_existing = body_text.split("## 本文（newspaper3k）")[0]
-                new_body = pre_existing + header + extracted_text
-            else:
-                new_body = body_text + header + extracted_text
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error processing {file_path.name}: {e}")
+        return None
 
-            # Reconstruct file
-            new_content = "---\n" + frontmatter_str + "---" + new_body
+def write_result(result):
+    file_path, frontmatter_str, body_text, extracted_text = result
+    try:
+        # The hash of the extracted text is stored under the header,
+        # so an unchanged article does not rewrite the note
+        new_hash = hashlib.blake2b(extracted_text.encode("utf-8"), digest_size=16).hexdigest()
+        hash_marker = f"<!-- hash:{new_hash} -->"
 
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(new_content)
+        # Append section
+        header = f"\n\n{BODY_HEADER}\n{hash_marker}\n"
 
-            print("Updated.")
+        # Check if header already exists
+        if BODY_HEADER in body_text:
+            pre_existing, existing_section = body_text.split(BODY_HEADER, 1)
+            if hash_marker in existing_section:
+                print(f"Unchanged: {file_path.name}")
+                return
+
+            # Replace existing section (regex or split)
+            # Simple approach: split by header and keep first part
+            new_body = pre_existing + header + extracted_text
+        else:
+            new_body = body_text + header + extracted_text
+
+        # Reconstruct file
+        new_content = "---\n" + frontmatter_str + "---" + new_body
+
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(new_content)
+
+        print(f"Updated: {file_path.name}")
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error writing {file_path.name}: {e}")
+
+def fetch_raindrop_body():
+    parser = argparse.ArgumentParser(description="Fetch article body for Raindrop notes.")
+    parser.add_argument("start_date", nargs="?", help="Start date (YYYY-MM-DD) to filter files by created date.")
+    args = parser.parse_args()
+
+    if not VAULT_DIR:
+        print("Error: VAULT_DIR is not set in .env")
+        return
+
+    raindrop_dir = Path(VAULT_DIR) / "20_inputs/Resource_Raindrop"
+    if not raindrop_dir.exists():
+        print(f"Directory not found: {raindrop_dir}")
+        return
+
+    start_date = None
+    if args.start_date:
+        try:
+            start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d").date()
+        except ValueError:
+            print("Invalid date format. Use YYYY-MM-DD.")
+            return
+
+    files = list(raindrop_dir.glob("*.md"))
+    if not files:
+        print("No files found.")
+        return
 
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f"Error processing {file_path.name}: {e}")
+    # Downloads run concurrently; writes stay on the main thread
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as ex:
+        for result in ex.map(partial(parse_and_fetch, start_date=start_date), files):
+            if result:
+                write_result(result)
 
 if __name__ == "__main__":
     fetch_raindrop_body()
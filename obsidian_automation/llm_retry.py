@@ -0,0 +1,27 @@
+import random
+
+# Retry policy shared by every script that calls an LLM API
+MAX_ATTEMPTS = 5
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+def backoff_delay(attempt):
+    """
+    attempt 回目（0始まり）の失敗後に待つ秒数
+    指数バックオフにジッターを加え、並行するリクエストが同時に再試行しないようにする
+    """
+    return min(2 ** attempt, 30) + random.uniform(0, 0.5)
+
+def is_retryable_genai_error(e):
+    """
+    google-genai の呼び出しで再試行すべき一時的なエラーかどうか
+    """
+    # API errors carry the HTTP status code in .code
+    if getattr(e, "code", None) in RETRY_STATUSES:
+        return True
+
+    # Timeouts and connection failures surface as httpx transport errors (no .code)
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(e, httpx.TransportError)
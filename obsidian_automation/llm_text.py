@@ -0,0 +1,15 @@
+import re
+
+# A whole reply wrapped in one ```json / ```markdown (or bare ```) fence, on one
+# line or several. Both ends are matched together, so a code block inside the
+# reply is left alone; (?!\w) keeps e.g. a ```python block from losing its fence.
+_FENCED_REPLY_RE = re.compile(r"^\s*```(?:json|markdown)?(?!\w)[ \t]*\n?(.*?)\n?```\s*$", re.S)
+
+def strip_code_fence(text):
+    """
+    LLMの応答全体がコードフェンスで囲まれていれば外し、前後の空白を除いて返す
+    """
+    match = _FENCED_REPLY_RE.match(text)
+    if match:
+        text = match.group(1)
+    return text.strip()
@@ -1,21 +1,29 @@
-from unittest.mock import MagicMock
 import json
+import re
+
+class _MockResp:
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
 
 class MockGenAIClient:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, http_options=None):
         pass
 
     def generate_content(self, model, contents, config=None):
         prompt = contents[0] if isinstance(contents, list) else contents
-        response = MagicMock()
 
         # Simple heuristic to determine which mock response to return
         if "Kindle本のハイライト" in prompt:
-            # Kindle Classification
-            response.text = '{"theme": "健康"}'
+            # Kindle Classification (one entry per [[id]] in the batch)
+            ids = re.findall(r"^\[\[(\d+)\]\]$", prompt, re.MULTILINE)
+            response_text = json.dumps(
+                [{"id": int(i), "theme": "健康"} for i in ids], ensure_ascii=False
+            )
         elif "行動レベルに落とし込むコーチ" in prompt:
             # Daily Coaching
-            response.text = """## 改善ポイント（AIコーチ）
+            response_text = """## 改善ポイント（AIコーチ）
 - もっと早く寝るべきでした。
 
 ## 明日のアクション（AIコーチ）
@@ -24,7 +32,7 @@ class MockGenAIClient:
 - [ ] ストレッチする"""
         elif "1週間分の振り返り" in prompt:
             # Weekly Review
-            response.text = """## 今週のハイライト
+            response_text = """## 今週のハイライト
 - プロジェクトA完了
 - 家族で公園に行った
 - 本を1冊読了
@@ -47,9 +55,9 @@ class MockGenAIClient:
 - [ ] スマホをリビングに置く
 - [ ] 朝散歩する"""
         else:
-            response.text = "Mock response"
+            response_text = "Mock response"
 
-        return response
+        return _MockResp(response_text)
 
 class MockArticle:
     def __init__(self, url):
@@ -63,11 +71,14 @@ class MockArticle:
     def parse(self):
         pass
 
-def mock_convert_from_path(pdf_path):
+def mock_convert_from_path(pdf_path, **kwargs):
     # Returns a list of dummy PIL images
     from PIL import Image
     return [Image.new('RGB', (100, 100), color = 'white')]
 
+def mock_pdfinfo_from_path(pdf_path, **kwargs):
+    return {"Pages": 1}
+
 def mock_image_to_string(image, lang='jpn'):
     return """
 #1 今日のスキャン
@@ -2,10 +2,35 @@ import os
 import sys
 import json
 import re
+import asyncio
+import functools
+import hashlib
+import tempfile
+import unicodedata
+import time
 import argparse
-import requests
 from pathlib import Path
 from dotenv import load_dotenv
+from llm_retry import MAX_ATTEMPTS, RETRY_STATUSES, backoff_delay
+from llm_text import strip_code_fence
+
+# orjson is faster; fall back to the standard library if it is not installed
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps_bytes = orjson.dumps
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
+    def _json_dumps_bytes(obj):
+        return _json_dumps(obj).encode("utf-8")
 
 # Load .env from script directory
 script_dir = Path(__file__).parent
@@ -16,81 +41,110 @@ VAULT_DIR = os.getenv("VAULT_DIR")
 API_KEY = os.getenv("OPENROUTER_API_KEY")
 API_ENDPOINT = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "meta-llama/llama-3.3-70b-instruct:free"
-
-PROMPT_TEMPLATE = """
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_CONCURRENCY = 4
+
+@functools.lru_cache(maxsize=1)
+def _session():
+    # Shared session: keeps the TLS connection to OpenRouter alive across requests.
+    # Everything goes to one host, so pool_maxsize is what bounds concurrent batches.
+    # requests is imported here so that --help and cache hits do not pay for it.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+    return session
+
+# Transient failures are retried with the shared backoff policy (see post_with_retry)
+REQUEST_TIMEOUT = (10, 300)  # (connect, read) seconds
+
+# The prompt is assembled as head + note blocks + tail, so no template has to be
+# parsed around the (potentially large) note contents
+_PROMPT_HEAD = """
 あなたは優秀なライター兼情報整理のアシスタントです。
-渡されたノートのコンテンツを分析し、トピックごとに要約して、指定されたJSON形式で出力してください。
+渡された各ノートのコンテンツを分析し、ノートごとにトピック別に要約して、指定されたJSON形式で出力してください。
+ノートは [[note id=番号]] から [[/note]] までです。
 
-## 入力情報
-- source_type: {source_type}
-- source_path: {source_path}
-- date: {date}
+## ノート
+"""
 
-## コンテンツ
-{content}
+_PROMPT_TAIL = """
 
 ## 出力要件
 以下のJSON形式のみを出力してください。
 ```json
-{{
-  "source_type": "{source_type}",
-  "source_path": "{source_path}",
-  "date": "{date}",
-  "topics": [
-    {{
-      "title": "短い日本語タイトル",
-      "summary": "日本語で2〜4文の要約。",
-      "tags": ["#topic/仕事"]
-    }}
+{
+  "results": [
+    {
+      "id": 1,
+      "topics": [
+        {
+          "title": "短い日本語タイトル",
+          "summary": "日本語で2〜4文の要約。",
+          "tags": ["#topic/仕事"]
+        }
+      ]
+    }
   ]
-}}
+}
 ```
 
 注意事項:
+- resultsには、すべてのノートについて1件ずつ、idをノートの番号に合わせて出力してください。
 - tagsは、コンテンツの内容に合わせて適切なものを付与してください。#topic/仕事, #topic/アイデア, #topic/振り返り など。
 - topicsは複数あっても構いません。話題が変わるごとに分割してください。
 - タイトルはファイル名に使用するため、簡潔にしてください。
 - summaryは日本語で2〜4文程度で要約してください。
 """
 
-MARKDOWN_TEMPLATE = """---
-tags: {tags}
-source_type: {source_type}
-source_path: {source_path}
-created: {date}
-index: {index}
----
+def _render(tags, source_type, source_path, date, index, title, summary):
+    """
+    トピック1件分のMarkdown（frontmatter + 本文）を組み立てる
+    """
+    return (
+        "---\n"
+        f"tags: {tags}\n"
+        f"source_type: {source_type}\n"
+        f"source_path: {source_path}\n"
+        f"created: {date}\n"
+        f"index: {index}\n"
+        "---\n"
+        "\n"
+        f"# {title}\n"
+        "\n"
+        f"{summary}\n"
+    )
 
-# {title}
+_DATE_ISO = re.compile(r"(\d{4}-\d{2}-\d{2})")
+_DATE_YMD = re.compile(r"^(\d{4})(\d{2})(\d{2})_")
+_BAD_FS_CHARS = re.compile(r'[\\/:*?"<>|]')
 
-{summary}
-"""
 
 def get_meta_info(filepath_str):
     """
     パスとファイル名からメタ情報を推定する
     """
-    path = Path(filepath_str)
-    filename = path.name
+    filename = Path(filepath_str).name
 
     source_type = "unknown"
     date_str = "0000-00-00"
 
-    # source_type logic
-    if "Voicememo" in str(path) or "Voicememo" in path.parts:
+    # source_type logic (a substring match on the path also covers every part of it)
+    if "Voicememo" in filepath_str:
         source_type = "voicememo"
-    elif "Manual" in str(path) or "Manual" in path.parts:
+    elif "Manual" in filepath_str:
         source_type = "manual"
 
     # date logic
     if source_type == "voicememo":
         # Expecting YYYY-MM-DD in filename
-        match = re.search(r"(\d{4}-\d{2}-\d{2})", filename)
+        match = _DATE_ISO.search(filename)
         if match:
             date_str = match.group(1)
     elif source_type == "manual":
         # Expecting YYYYMMDD_...
-        match = re.search(r"^(\d{4})(\d{2})(\d{2})_", filename)
+        match = _DATE_YMD.search(filename)
         if match:
             date_str = f"{match.group(1)}-{match.group(2)}-{match.group(3)}"
 
@@ -106,70 +160,116 @@ def generate_slug(title):
     # Remove invalid characters for filenames (simple approach)
     # Keep alphanumeric, underscores, hyphens, and japanese chars
     # Remove: / \ : * ? " < > |
-    slug = re.sub(r'[\\/:*?"<>|]', '', slug)
+    slug = _BAD_FS_CHARS.sub('', slug)
 
     return slug
 
-def get_unique_filepath(directory, filename):
+def _name_key(filename):
+    # APFS/NTFS treat names case- and normalization-insensitively, so compare them that way
+    return unicodedata.normalize("NFC", filename).casefold()
+
+def get_unique_filepath(directory, filename, existing):
     """
     同名のファイルが存在する場合は、末尾に連番を振って衝突を避ける
+    existing はディレクトリ内の既存ファイル名（_name_key 済み）の集合で、選んだ名前を追加していく
     Example: file.md -> file_1.md -> file_2.md
     """
-    base_path = directory / filename
-    if not base_path.exists():
-        return base_path
+    if _name_key(filename) not in existing:
+        existing.add(_name_key(filename))
+        return directory / filename
 
-    stem = base_path.stem
-    suffix = base_path.suffix
+    stem, suffix = os.path.splitext(filename)
 
     counter = 1
     while True:
         new_filename = f"{stem}_{counter}{suffix}"
-        new_path = directory / new_filename
-        if not new_path.exists():
-            return new_path
+        if _name_key(new_filename) not in existing:
+            existing.add(_name_key(new_filename))
+            return directory / new_filename
         counter += 1
 
-def main():
-    parser = argparse.ArgumentParser(description="Summarize Obsidian note using LLM.")
-    parser.add_argument("filepath", help="Path to the source note (relative to VAULT_DIR)")
-    args = parser.parse_args()
-
-    if not VAULT_DIR:
-        print("Error: VAULT_DIR is not set in .env")
-        sys.exit(1)
-
-    if not API_KEY:
-        print("Error: OPENROUTER_API_KEY is not set in .env")
-        sys.exit(1)
+def get_unique_filepaths(directory, filenames, existing=None):
+    """
+    複数のファイル名の衝突をまとめて解決する
+    existing を省略した場合は、ディレクトリを一度だけ読み込んで使う
+    """
+    if existing is None:
+        existing = {_name_key(name) for name in os.listdir(directory)}
+    return [get_unique_filepath(directory, filename, existing) for filename in filenames]
 
-    # Resolve paths
-    vault_path = Path(VAULT_DIR)
-    source_rel_path = args.filepath
+def load_note(vault_path, source_rel_path):
+    """
+    ノートを読み込み、メタ情報と本文をまとめて返す（失敗時は None）
+    """
     source_full_path = vault_path / source_rel_path
 
     if not source_full_path.exists():
         print(f"Error: File not found: {source_full_path}")
-        sys.exit(1)
+        return None
 
-    # 2. Estimate meta info
+    # Estimate meta info
     source_type, date_str = get_meta_info(source_rel_path)
 
-    # 3. Read content
+    # Read content
     try:
-        with open(source_full_path, "r", encoding="utf-8") as f:
-            content = f.read()
-    except Exception as e:
+        content = source_full_path.read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError) as e:
         print(f"Error reading file: {e}")
-        sys.exit(1)
+        return None
 
-    # 4. Call LLM
-    prompt = PROMPT_TEMPLATE.format(
-        source_type=source_type,
-        source_path=source_rel_path,
-        date=date_str,
-        content=content
-    )
+    return {
+        "source_type": source_type,
+        "source_path": source_rel_path,
+        "date": date_str,
+        "content": content
+    }
+
+def build_prompt(notes):
+    """
+    複数のノートを番号付きで1つのプロンプトにまとめる（番号は1始まり）
+    """
+    parts = [_PROMPT_HEAD]
+    for i, note in enumerate(notes, start=1):
+        parts.append(
+            f"\n[[note id={i}]]\n"
+            f"- source_type: {note['source_type']}\n"
+            f"- source_path: {note['source_path']}\n"
+            f"- date: {note['date']}\n"
+            f"\n{note['content']}\n"
+            f"[[/note]]\n"
+        )
+    parts.append(_PROMPT_TAIL)
+    return "".join(parts)
+
+def post_with_retry(headers, body):
+    """
+    タイムアウト・接続エラー・一時的なHTTPエラーは指数バックオフで再試行する
+    """
+    import requests
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = _session().post(API_ENDPOINT, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return response
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError) as e:
+            if isinstance(e, requests.exceptions.HTTPError):
+                retryable = e.response is not None and e.response.status_code in RETRY_STATUSES
+            else:
+                retryable = True
+            if attempt == MAX_ATTEMPTS - 1 or not retryable:
+                raise
+            wait = backoff_delay(attempt)
+            print(f"API Request Error ({e}), retrying in {wait:.1f}s...")
+            time.sleep(wait)
+
+def call_llm(prompt):
+    """
+    LLMを呼び出し、応答本文を返す（失敗時は None）
+    """
+    import requests
 
     headers = {
         "Authorization": f"Bearer {API_KEY}",
@@ -177,67 +277,91 @@ def main():
         "HTTP-Referer": "https://github.com/obsidian-automation", # Optional: for OpenRouter rankings
     }
 
-    data = {
+    # Encode the request body once, straight to UTF-8 bytes
+    body = _json_dumps_bytes({
         "model": MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ],
         "response_format": {"type": "json_object"}
-    }
+    })
 
-    response = None
     try:
-        response = requests.post(API_ENDPOINT, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
+        response = post_with_retry(headers, body)
+        result = _json_loads(response.content)
 
         # Extract content from response
-        if "choices" in result and len(result["choices"]) > 0:
-            ai_content = result["choices"][0]["message"]["content"]
-        else:
-            print("Error: No choices in API response")
-            print(result)
-            sys.exit(1)
-
-    except requests.exceptions.RequestException as e:
+        if isinstance(result, dict) and result.get("choices"):
+            try:
+                return result["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                pass
+
+        print("Error: No message content in API response")
+        print(result)
+        return None
+
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
         print(f"API Request Error: {e}")
+        response = getattr(e, "response", None)
         if response is not None:
              print(response.text)
-        sys.exit(1)
+        return None
 
-    # 5. Parse JSON
+def parse_results(ai_content):
+    """
+    LLMの応答から results を取り出し、id をキーにした辞書で返す（失敗時は None）
+    """
     try:
         # Clean up markdown code blocks if present
-        clean_json = ai_content.strip()
-        if clean_json.startswith("```json"):
-            clean_json = clean_json.replace("```json", "", 1)
-        if clean_json.startswith("```"): # Sometimes just ```
-            clean_json = clean_json.replace("```", "", 1)
-        if clean_json.endswith("```"):
-            clean_json = clean_json[:-3]
+        clean_json = strip_code_fence(ai_content)
 
-        clean_json = clean_json.strip()
-
-        parsed_data = json.loads(clean_json)
+        parsed_data = _json_loads(clean_json)
     except json.JSONDecodeError as e:
         print(f"Error: Failed to parse JSON from LLM response.")
         print(f"Raw response: {ai_content}")
         print(f"JSON Error: {e}")
-        sys.exit(1)
+        return None
 
-    # Validate topics
-    topics = parsed_data.get("topics", [])
-    if not topics:
-        print("No topics found. Exiting.")
-        sys.exit(0)
+    results = parsed_data.get("results", []) if isinstance(parsed_data, dict) else []
+    return {
+        str(item["id"]): item
+        for item in results
+        if isinstance(item, dict) and "id" in item
+    }
 
-    # 6. Generate Markdown files
-    fleeting_dir = vault_path / "10_fleeting"
-    fleeting_dir.mkdir(parents=True, exist_ok=True)
+def write_topic(output_path, md_content):
+    # "x" never overwrites an existing note; if the name is taken after all, bump the counter
+    path = output_path
+    counter = 1
+    while True:
+        try:
+            with open(path, "x", encoding="utf-8") as f:
+                f.write(md_content)
+            return True
+        except FileExistsError:
+            path = output_path.with_name(f"{output_path.stem}_{counter}{output_path.suffix}")
+            counter += 1
+        except Exception as e:
+            print(f"Error writing file {path}: {e}")
+            return False
 
-    count = 0
-    for i, topic in enumerate(topics):
+async def write_topics(fleeting_dir, note, parsed_data, existing):
+    """
+    1つのノートのトピックをMarkdownファイルとして書き出し、作成数を返す
+    """
+    # Frontmatter metadata comes from the note itself; the model only supplies topics
+    source_type = note["source_type"]
+    source_rel_path = note["source_path"]
+    date_str = note["date"]
+
+    filenames = []
+    contents = []
+    for i, topic in enumerate(parsed_data.get("topics", [])):
         index = i + 1
+        if not isinstance(topic, dict):
+            print(f"Skipping malformed topic {index} for {source_rel_path}: {topic!r}")
+            continue
         title = topic.get("title", "No Title")
         summary = topic.get("summary", "")
         tags = topic.get("tags", [])
@@ -245,30 +369,175 @@ def main():
         slug = generate_slug(title)
 
         # Filename: {date}_{index:02d}_{slug}.md
-        filename = f"{date_str}_{index:02d}_{slug}.md"
-
-        # Resolve collision
-        output_path = get_unique_filepath(fleeting_dir, filename)
+        filenames.append(f"{date_str}_{index:02d}_{slug}.md")
 
         # Markdown Content
-        md_content = MARKDOWN_TEMPLATE.format(
-            tags=json.dumps(tags, ensure_ascii=False), # Convert list to valid string rep like ["#a", "#b"]
-            source_type=parsed_data.get("source_type", source_type),
-            source_path=parsed_data.get("source_path", source_rel_path),
-            date=parsed_data.get("date", date_str),
+        contents.append(_render(
+            tags=_json_dumps(tags), # Convert list to valid string rep like ["#a", "#b"]
+            source_type=source_type,
+            source_path=source_rel_path,
+            date=date_str,
             index=index,
             title=title,
             summary=summary
-        )
+        ))
 
-        try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(md_content)
-            count += 1
-        except Exception as e:
-            print(f"Error writing file {output_path}: {e}")
+    # Resolve collisions for all topics at once (kept synchronous so names are never handed out twice)
+    output_paths = get_unique_filepaths(fleeting_dir, filenames, existing)
+
+    writes = [
+        asyncio.to_thread(write_topic, output_path, md_content)
+        for output_path, md_content in zip(output_paths, contents)
+    ]
+
+    # File writes overlap in worker threads
+    return sum(await asyncio.gather(*writes))
+
+def get_cache_path(prompt):
+    """
+    (MODEL, prompt) の SHA-256 をキーにしたキャッシュファイルのパス
+    """
+    key = hashlib.sha256((MODEL + "\0" + prompt).encode("utf-8")).hexdigest()
+    return Path(VAULT_DIR) / ".cache" / "summaries" / f"{key}.json"
+
+def load_cached_response(cache_path):
+    try:
+        return _json_loads(cache_path.read_bytes())["content"]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        # Unreadable entry: treat as a miss and overwrite it later
+        return None
+
+def save_cached_response(cache_path, ai_content):
+    # Write to a sibling temp file and rename, so readers never see a partial entry
+    tmp_name = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=cache_path.parent, suffix=".tmp", delete=False
+        ) as f:
+            tmp_name = f.name
+            f.write(_json_dumps({"model": MODEL, "content": ai_content}))
+        os.replace(tmp_name, cache_path)
+    except OSError as e:
+        print(f"Warning: Failed to write cache {cache_path}: {e}")
+        # Don't leave the half-written temp file behind in the cache directory
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except FileNotFoundError:
+                pass
+
+async def summarize_batch(batch, sem, fleeting_dir, existing, use_cache=True):
+    """
+    1バッチ分のノートを要約して書き出す（成功時に True）
+    """
+    try:
+        prompt = build_prompt(batch)
+        cache_path = get_cache_path(prompt)
+
+        ai_content = load_cached_response(cache_path) if use_cache else None
+        cache_hit = ai_content is not None
+
+        if not cache_hit:
+            # Build the shared session on the event loop thread, before any worker thread
+            # can race to create its own
+            _session()
+
+            # The blocking HTTP call runs in a worker thread; the semaphore caps requests in flight
+            async with sem:
+                ai_content = await asyncio.to_thread(call_llm, prompt)
+            if ai_content is None:
+                return False
+
+        results = parse_results(ai_content)
+        if results is None:
+            return False
+
+        # Only responses that parsed are cached, so a bad reply is retried next run
+        if use_cache and not cache_hit:
+            save_cached_response(cache_path, ai_content)
+
+        # Filenames are resolved on the event loop thread, so collision checks cannot race
+        for i, note in enumerate(batch, start=1):
+            parsed_data = results.get(str(i))
+            topics = parsed_data.get("topics") if parsed_data else None
+            if not topics or not isinstance(topics, list):
+                print(f"No topics found for {note['source_path']}.")
+                continue
+
+            count = await write_topics(fleeting_dir, note, parsed_data, existing)
+            print(f"Created {count} notes for {note['source_path']}")
+
+        return True
+    except Exception as e:
+        # A bad batch must not abort the others (their responses are already paid for)
+        import traceback
+        traceback.print_exc()
+        names = ", ".join(note["source_path"] for note in batch)
+        print(f"Error processing {names}: {e}")
+        return False
+
+async def summarize_many(paths, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY, use_cache=True):
+    """
+    複数のノートを batch_size 件ずつ1回のLLM呼び出しで要約する
+    バッチは最大 concurrency 件まで並行してリクエストする
+    use_cache が True なら、同じモデル・プロンプトの応答をディスクキャッシュから再利用する
+    すべて成功した場合に True を返す
+    """
+    vault_path = Path(VAULT_DIR)
+    ok = True
+
+    # Read the notes in worker threads so a slow disk doesn't block the loop
+    loaded = await asyncio.gather(
+        *(asyncio.to_thread(load_note, vault_path, source_rel_path) for source_rel_path in paths)
+    )
+    notes = [note for note in loaded if note is not None]
+    if len(notes) < len(loaded):
+        ok = False
+
+    fleeting_dir = vault_path / "10_fleeting"
+    fleeting_dir.mkdir(parents=True, exist_ok=True)
+
+    # One directory listing instead of a stat per collision probe
+    existing = {_name_key(entry.name) for entry in os.scandir(fleeting_dir)}
+
+    sem = asyncio.Semaphore(concurrency)
+    batches = [notes[i:i + batch_size] for i in range(0, len(notes), batch_size)]
+    results = await asyncio.gather(
+        *(summarize_batch(batch, sem, fleeting_dir, existing, use_cache) for batch in batches)
+    )
+
+    return ok and all(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize Obsidian notes using LLM.")
+    parser.add_argument("filepaths", nargs="+", help="Paths to the source notes (relative to VAULT_DIR)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of notes summarized per LLM request (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Maximum number of LLM requests in flight (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the LLM instead of reusing cached responses")
+    args = parser.parse_args()
 
-    print(f"Created {count} notes for {source_rel_path}")
+    if not VAULT_DIR:
+        print("Error: VAULT_DIR is not set in .env")
+        sys.exit(1)
+
+    if not API_KEY:
+        print("Error: OPENROUTER_API_KEY is not set in .env")
+        sys.exit(1)
+
+    if args.batch_size < 1 or args.concurrency < 1:
+        print("Error: --batch-size and --concurrency must be at least 1")
+        sys.exit(1)
+
+    if not asyncio.run(summarize_many(
+        args.filepaths, args.batch_size, args.concurrency, use_cache=not args.no_cache
+    )):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
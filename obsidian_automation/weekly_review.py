@@ -2,8 +2,15 @@ import os
 import argparse
 import sys
 import datetime
+import functools
+import importlib.util
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
+from llm_retry import MAX_ATTEMPTS, backoff_delay, is_retryable_genai_error
+from llm_text import strip_code_fence
 
 # Load .env from script directory
 script_dir = Path(__file__).parent
@@ -14,23 +21,29 @@ VAULT_DIR = os.getenv("VAULT_DIR")
 API_KEY = os.getenv("GEMINI_API_KEY")
 USE_MOCK = os.getenv("USE_MOCK", "false").lower() == "true"
 
+# Decide on mocks up front; find_spec only locates google.genai without importing it
 if not USE_MOCK:
     try:
-        from google import genai
-        from google.genai import types
-    except ImportError:
+        USE_MOCK = importlib.util.find_spec("google.genai") is None
+    except ModuleNotFoundError:
         USE_MOCK = True
 
 if USE_MOCK:
     print("Using Mocks")
-    from mocks import MockGenAIClient
-    class MockGenAIModule:
-        Client = MockGenAIClient
-    genai = MockGenAIModule()
 
-client = genai.Client(api_key=API_KEY)
+@functools.lru_cache(maxsize=1)
+def _client():
+    # google.genai is slow to import, so it is only loaded once a review is
+    # actually generated (not for the usage message or an empty week)
+    if USE_MOCK:
+        from mocks import MockGenAIClient
+        return MockGenAIClient(api_key=API_KEY, http_options={"timeout": 60_000})
 
-WEEKLY_PROMPT_TEMPLATE = """
+    from google import genai
+    return genai.Client(api_key=API_KEY, http_options={"timeout": 60_000})
+
+# The weekly text is appended after this fixed head
+_WEEKLY_PROMPT_HEAD = """
 あなたは1週間分の振り返りを手伝うコーチです。
 以下は、ある1週間分のデイリーノートから抜き出したテキストです。
 
@@ -78,7 +91,6 @@ WEEKLY_PROMPT_TEMPLATE = """
 
 以下が1週間分のテキストです：
 
-{weekly_text}
 """
 
 def get_week_range(iso_week_str):
@@ -96,50 +108,64 @@ def get_week_range(iso_week_str):
     except ValueError:
         return None, None
 
+
+# Every "## " header line in a daily note
+_HEADER_RE = re.compile(r"^## (.+?)[ \t]*$", re.MULTILINE)
+SCAN_LABEL = "今日のスキャン"
+ACTION_LABEL = "明日のアクション（AIコーチ）"
+
 def extract_daily_content(file_path):
     if not file_path.exists():
         return ""
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
+    content = file_path.read_text(encoding="utf-8")
 
     # Extract "今日のスキャン" (Events/Reflection)
     # Extract "明日のアクション（AIコーチ）"
-    # Simple parsing: find headers and take content until next header
-
-    result = f"--- Date: {file_path.stem} ---\n"
-
-    scan_header = "## 今日のスキャン"
-    action_header = "## 明日のアクション（AIコーチ）"
-
-    def get_section(text, header):
-        if header not in text:
-            return ""
-        parts = text.split(header)
-        if len(parts) < 2:
-            return ""
-        section = parts[1]
-        # stop at next header (starts with ## )
-        # split by newline, check if line starts with ##
-        lines = section.split('\n')
-        extracted_lines = []
-        for line in lines:
-            if line.strip() == "": # Skip empty first line usually
-                continue
-            if line.startswith("## "):
-                break
-            extracted_lines.append(line)
-        return '\n'.join(extracted_lines).strip()
-
-    scan_content = get_section(content, scan_header)
-    action_content = get_section(content, action_header)
+    # Single pass over the "## " headers; each section runs until the next header
+    sections = {}
+    matches = list(_HEADER_RE.finditer(content))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        label = match.group(1)
+        if label in (SCAN_LABEL, ACTION_LABEL) and label not in sections:
+            end = next_match.start() if next_match else len(content)
+            sections[label] = content[match.end():end].strip()
+
+    scan_content = sections.get(SCAN_LABEL, "")
+    action_content = sections.get(ACTION_LABEL, "")
+
+    result_parts = [f"--- Date: {file_path.stem} ---\n"]
 
     if scan_content:
-        result += f"[今日の出来事・反省]\n{scan_content}\n\n"
+        result_parts.append(f"[今日の出来事・反省]\n{scan_content}\n\n")
     if action_content:
-        result += f"[明日のアクション（AIコーチ）]\n{action_content}\n\n"
-
-    return result
+        result_parts.append(f"[明日のアクション（AIコーチ）]\n{action_content}\n\n")
+
+    return "".join(result_parts)
+
+def generate_content(prompt):
+    client = _client()
+    if USE_MOCK:
+        return client.generate_content(
+            model="gemini-2.0-flash",
+            contents=prompt
+        )
+    return client.models.generate_content(
+        model="gemini-2.0-flash",
+        contents=prompt
+    )
+
+def generate_with_retry(prompt):
+    # Timeouts, rate limits and 5xx responses are retried with exponential backoff + jitter
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return generate_content(prompt)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable_genai_error(e):
+                raise
+            wait = backoff_delay(attempt)
+            print(f"API busy ({e}), retrying in {wait:.1f}s...")
+            time.sleep(wait)
 
 def weekly_review(iso_week_str):
     if not VAULT_DIR:
@@ -157,45 +183,30 @@ def weekly_review(iso_week_str):
     weekly_dir = Path(VAULT_DIR) / "60_weekly"
     weekly_dir.mkdir(parents=True, exist_ok=True)
 
-    # Collect texts
-    weekly_text = ""
-    current = start_date
-    while current <= end_date:
-        date_str = current.strftime("%Y-%m-%d")
-        file_path = daily_dir / f"{date_str}.md"
-        weekly_text += extract_daily_content(file_path)
-        current += datetime.timedelta(days=1)
+    # Collect texts (Monday..Sunday)
+    paths = [
+        daily_dir / f"{(start_date + datetime.timedelta(days=i)).isoformat()}.md"
+        for i in range(7)
+    ]
+
+    # Read the daily notes concurrently; map keeps them in date order
+    with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+        chunks = list(ex.map(extract_daily_content, paths))
+    weekly_text = "".join(chunks)
 
     if not weekly_text.strip():
         print("No daily notes found for this week.")
         return
 
     # Call AI
-    prompt = WEEKLY_PROMPT_TEMPLATE.format(weekly_text=weekly_text)
+    prompt = f"{_WEEKLY_PROMPT_HEAD}{weekly_text}\n"
 
     try:
-        if USE_MOCK:
-             response = client.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt
-            )
-        else:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=prompt
-            )
+        response = generate_with_retry(prompt)
         ai_response = response.text
 
         # Clean markdown fences
-        if ai_response.startswith("```markdown"):
-            ai_response = ai_response.replace("```markdown", "", 1)
-            if ai_response.endswith("```"):
-                ai_response = ai_response[:-3]
-        elif ai_response.startswith("```"):
-            ai_response = ai_response.replace("```", "", 1)
-            if ai_response.endswith("```"):
-                ai_response = ai_response[:-3]
-        ai_response = ai_response.strip()
+        ai_response = strip_code_fence(ai_response)
 
     except Exception as e:
         print(f"AI Failed: {e}")